@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import pytz
 
 from datetime import datetime, timedelta
@@ -11,8 +12,8 @@ from pydsd.DropSizeDistribution import DropSizeDistribution
 
 def read_adm_parsivel(filename):
     """
-    Takes a filename pointing to an Argonne parsivel raw file and returns
-    a drop size distribution object.
+    Takes a filename pointing to an Argonne parsivel raw file, or an open
+    buffer with its contents, and returns a drop size distribution object.
 
     Usage:
     dsd = read_parsivel(filename)
@@ -90,40 +91,42 @@ class ArgonneParsivelReader(object):
         #Timestamp (UTC);	Sensor Serial Num (%13);	Sensor Date (%21);	Sensor Time (%20);	Sensor Status (%18);	Error Code    (%25);	Power #Supply Voltage (%17);	Sensor Head Heating Current (%16);	Temperature in the right sensor head (%27);	Temperature in the left sensor #head (%28);	Sensor Heating Temperature (%12);	Rain Intensity (%01);	Rain Amount Accumulated (%02);	Radar Reflectivity (%07);	#Number of Particles Validated (%11);	Number of Particles Detected (%60);	N(d) (%90);	v(d) (%91);	Raw Data (%93)
 
          
-        with open(self.filename) as f:
-            line1 = f.readline()
-            line2 = f.readline()
-            for file_line in f:
-                
-                if file_line == "":
-                    continue
-                split_string = file_line.split(";")
-                self.time.append(np.datetime64(split_string[0]))
-                self.sensor_serial_num = int(split_string[1])
-                sensor_date = split_string[2]
-                sensor_date = datetime.strptime(sensor_date, '%d.%m.%Y').strftime("%Y-%m-%d")
-                sensor_time = split_string[3]
-                self.sensor_time.append(np.datetime64(f"{sensor_date}T{sensor_time}"))
-                self.sensor_status.append(int(split_string[4]))
-                self.error_code.append(int(split_string[5]))
-                self.power_supply_voltage.append(float(split_string[6]))
-                self.sensor_head_heating_current.append(float(split_string[7]))
-                self.temperature_right_head.append(int(split_string[8]))
-                self.temperature_left_head.append(int(split_string[9]))
-                self.sensor_heating_temperature.append(int(split_string[10]))
-                self.rain_rate.append(float(split_string[11]))
-                self.rain_accumulation.append(float(split_string[12]))
-                self.Z.append(float(split_string[13]))
-                self.num_particles_validated.append(int(split_string[14]))
-                self.num_particles.append(int(split_string[15]))
-                nd_array = [float(x) for x in split_string[16:48]]
-                self.nd.append(nd_array)
-                vd_array = [float(x) for x in split_string[48:80]]
-                self.vd.append(vd_array)
-                raw_array = [float(x) for x in split_string[80:1104]]
-                self.raw.append(raw_array)
-              
-                         
+        # Parse every record in one pass of the pandas C parser, which accepts
+        # an open text or binary buffer as well as a path. The N(d), v(d) and
+        # raw spectrum columns (16 onwards) are read straight into float64 arrays,
+        # the dtype _prep_data and _apply_pcm_matrix work in, so neither copies them.
+        try:
+            df = pd.read_csv(
+                self.filename, sep=";", header=None, skiprows=2,
+                usecols=range(1104),
+                dtype={0: str, 2: str, 3: str, **{i: np.float64 for i in range(16, 1104)}},
+            )
+        except pd.errors.EmptyDataError:
+            return
+        if len(df) == 0:
+            return
+
+        self.time = np.array(df[0].to_numpy(), dtype='datetime64[s]')
+        self.sensor_serial_num = int(df[1].iloc[-1])
+        self.sensor_time = pd.to_datetime(
+            df[2] + " " + df[3], format="%d.%m.%Y %H:%M:%S"
+        ).to_numpy(dtype='datetime64[s]')
+        self.sensor_status = df[4].to_numpy(dtype=int)
+        self.error_code = df[5].to_numpy(dtype=int)
+        self.power_supply_voltage = df[6].to_numpy(dtype=float)
+        self.sensor_head_heating_current = df[7].to_numpy(dtype=float)
+        self.temperature_right_head = df[8].to_numpy(dtype=int)
+        self.temperature_left_head = df[9].to_numpy(dtype=int)
+        self.sensor_heating_temperature = df[10].to_numpy(dtype=int)
+        self.rain_rate = df[11].to_numpy(dtype=float)
+        self.rain_accumulation = df[12].to_numpy(dtype=float)
+        self.Z = df[13].to_numpy(dtype=float)
+        self.num_particles_validated = df[14].to_numpy(dtype=int)
+        self.num_particles = df[15].to_numpy(dtype=int)
+        self.nd = df.iloc[:, 16:48].to_numpy()
+        self.vd = df.iloc[:, 48:80].to_numpy()
+        self.raw = df.iloc[:, 80:1104].to_numpy()
+
     def get_sec(self, s):
         return int(s[0]) * 3600 + int(s[1]) * 60 + int(s[2])
     
@@ -132,13 +135,10 @@ class ArgonneParsivelReader(object):
         Returns: None
 
         """
-        self.filtered_raw_matrix = np.ndarray(
-            shape=(len(self.raw), 32, 32), dtype=float
+        # Broadcast the 32x32 matrix over every record in one pass
+        self.filtered_raw_matrix = np.multiply(
+            self.pcm, np.reshape(np.asarray(self.raw, dtype=float), (-1, 32, 32))
         )
-        for i in range(len(self.raw)):
-            self.filtered_raw_matrix[i] = np.multiply(
-                self.pcm, np.reshape(self.raw[i], (32, 32))
-            )
         self.fields["filtered_raw_matrix"] = var_to_dict(
             "Filtered raw counts using Tokay method",
             np.ma.masked_equal(self.filtered_raw_matrix, -9.999),
@@ -159,9 +159,13 @@ class ArgonneParsivelReader(object):
             "dBZ",
             "Equivalent reflectivity factor",
         )
+        # Mask the empty-bin value with a tolerance rather than exact float
+        # equality, reusing the parsed array instead of copying it
+        nd = np.asarray(self.nd, dtype=float)
+        empty_bin = np.isclose(nd, np.power(10, -9.999), rtol=0, atol=1e-12)
         self.fields["Nd"] = var_to_dict(
             "Nd",
-            np.ma.masked_equal(self.nd, np.power(10, -9.999)),
+            np.ma.masked_where(empty_bin, nd, copy=False),
             "m^-3 mm^-1",
             "Liquid water particle concentration",
         )
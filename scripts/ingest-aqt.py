@@ -20,10 +20,63 @@ import datetime
 import xarray as xr
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 from matplotlib.dates import DateFormatter
 
+# Map Beehive variable names to output variable names
+aqt_names = {'aqt.particle.pm2.5' : 'pm2.5',
+             'aqt.particle.pm1' : 'pm1.0',
+             'aqt.particle.pm10' : 'pm10.0',
+             'aqt.gas.no' : 'no',
+             'aqt.gas.ozone' : 'o3',
+             'aqt.gas.no2' : 'no2',
+             'aqt.gas.co' : 'co',
+             'aqt.env.temp' : 'temperature',
+             'aqt.env.humidity' : 'humidity',
+             'aqt.env.pressure' : 'pressure'}
+
+# Decimal places kept for each output variable, roughly the sensor resolution
+# (gases are in ppm, so they keep ppb-level precision)
+aqt_digits = {'pm2.5' : 2,
+              'pm1.0' : 2,
+              'pm10.0' : 2,
+              'no' : 3,
+              'o3' : 3,
+              'no2' : 3,
+              'co' : 3,
+              'temperature' : 1,
+              'humidity' : 1,
+              'dewpoint' : 1,
+              'pressure' : 1}
+
+def quantize(data, least_significant_digit):
+    """
+        Quantize data to a number of decimal places.
+
+        Zeroes the mantissa bits below least_significant_digit, the same
+        quantization netCDF4 applies for its least_significant_digit
+        encoding, so that zlib compresses the data much better.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Data to quantize.
+
+        least_significant_digit : int
+            Number of decimal places to keep.
+
+        Returns
+        -------
+        numpy.ndarray
+            Quantized data with the same dtype as data.
+
+    """
+    bits = np.ceil(np.log2(10.0 ** least_significant_digit))
+    scale = 2.0 ** bits
+    return (np.around(scale * data) / scale).astype(data.dtype)
+
 def ingest_aqt(st, global_attrs, var_attrs, odir='.' ):
     """
         Ingest from CROCUS AQTs using the Sage Data Client. 
@@ -62,75 +115,69 @@ def ingest_aqt(st, global_attrs, var_attrs, odir='.' ):
                                             "sensor" : "vaisala-aqt530"
                                         }
     )
-     # Rename specific column names
-    pm25 = df_aq[df_aq['name']=='aqt.particle.pm2.5']
-    pm10 = df_aq[df_aq['name']=='aqt.particle.pm1']
-    pm100 = df_aq[df_aq['name']=='aqt.particle.pm10']
-    no = df_aq[df_aq['name']=='aqt.gas.no']
-    o3 = df_aq[df_aq['name']=='aqt.gas.ozone']
-    no2 = df_aq[df_aq['name']=='aqt.gas.no2']
-    co = df_aq[df_aq['name']=='aqt.gas.co']
-    aqtemp = df_aq[df_aq['name']=='aqt.env.temp']
-    aqhum = df_aq[df_aq['name']=='aqt.env.humidity']
-    aqpres = df_aq[df_aq['name']=='aqt.env.pressure']
-
-    # Convert instrument timestamp to Pandas Datatime object
-    pm25['time'] = pd.DatetimeIndex(pm25['timestamp'].values)
+    # Reshape to one column per variable in a single pass, aligned on timestamp
+    aqvals = df_aq.pivot_table(index='timestamp', columns='name',
+                               values='value', aggfunc='first')
+    aqvals = aqvals.rename(columns=aqt_names).reindex(columns=list(aqt_names.values()))
+    aqvals = aqvals.astype('float32')
 
-    # Remove all meta data descriptions besides the index
-    aqvals = pm25.loc[:, pm25.columns.intersection(["time"])]
+    # Convert instrument timestamp to Pandas Datatime object, only parsing
+    # when sage_data_client did not already return datetimes
+    if not isinstance(aqvals.index, pd.DatetimeIndex):
+        aqvals.index = pd.to_datetime(aqvals.index, cache=True, utc=True)
+    if aqvals.index.tz is not None:
+        aqvals.index = aqvals.index.tz_convert(None)
+    aqvals.index.name = 'time'
+    aqvals.sort_index(inplace=True)
 
-    # Add all parameter to the output dataframe
-    aqvals['pm2.5'] = pm25.value.to_numpy().astype(float)
-    aqvals['pm1.0'] = pm10.value.to_numpy().astype(float)
-    aqvals['pm10.0'] = pm100.value.to_numpy().astype(float)
-
-    aqvals['no'] = no.value.to_numpy().astype(float)
-    aqvals['o3'] = o3.value.to_numpy().astype(float)
-    aqvals['no2'] = no2.value.to_numpy().astype(float)
-    aqvals['co'] = co.value.to_numpy().astype(float)
-    aqvals['temperature'] =  aqtemp.value.to_numpy().astype(float)
-    aqvals['humidity'] =  aqhum.value.to_numpy().astype(float)
-    aqvals['pressure'] =  aqpres.value.to_numpy().astype(float)
-
-    # calculate dewpoint from relative humidity
+    # calculate dewpoint from relative humidity, stripping the units
+    # so a plain array rather than a Quantity is stored in the frame
     dp = dewpoint_from_relative_humidity(aqvals.temperature.to_numpy() * units.degC, 
                                          aqvals.humidity.to_numpy() * units.percent
     )
-    aqvals['dewpoint'] = dp
-    
-    # Define the index
-    aqvals = aqvals.set_index("time")
+    aqvals['dewpoint'] = dp.to(units.degC).magnitude.astype('float32')
+
+    # ---------
+    # Apply QC
+    #----------
+    # Check for aerosol water vapor uptake and mask out
+    bad = ~((aqvals['humidity'] > 0) & (aqvals['humidity'] < 98))
+    aqvals.loc[bad, :] = np.nan
+
+    # Drop precision beyond the sensor resolution so the output compresses well.
+    # This is done here since the h5netcdf engine does not accept the
+    # least_significant_digit encoding.
+    for varname, digits in aqt_digits.items():
+        aqvals[varname] = quantize(aqvals[varname].to_numpy(), digits)
     
     end_fname = st.strftime('-%Y%m%d-%H%M%S.nc')
     start_fname = odir + '/crocus-' + global_attrs['site_ID'] + '-' + 'aqt-'+ global_attrs['datalevel']
     fname = start_fname + end_fname
     valsxr = xr.Dataset.from_dataframe(aqvals)
-    valsxr = valsxr.sortby('time')
     
     # Assign the global attributes
-    valsxr = valsxr.assign_attrs(global_attrs)
-    # Assign the individual parameter attributes
+    valsxr.attrs.update(global_attrs)
+    # Assign the individual parameter attributes in place
     for varname in var_attrs.keys():
-        valsxr[varname] = valsxr[varname].assign_attrs(var_attrs[varname])
+        valsxr[varname].attrs.update(var_attrs[varname])
     # Check if file exists and remove if necessary
     try:
         os.remove(fname)
     except OSError:
         pass
     
-    # ---------
-    # Apply QC
-    #----------
-    # Check for aerosol water vapor uptake and mask out
-    cond = (0 < valsxr.humidity) & (valsxr.humidity < 98)
-    valsxr = valsxr.where(cond, drop=False) 
-    
     # Ensure time is saved properly
     valsxr["time"] = pd.to_datetime(valsxr.time)
 
+    # Store every variable as chunked, deflated float32
+    chunksize = (min(len(valsxr.time), 8192),)
+    encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 1,
+                      'shuffle': True, 'chunksizes': chunksize,
+                      '_FillValue': np.float32(np.nan)} for var in var_attrs}
+
     if valsxr['pm2.5'].shape[0] > 0:
-        valsxr.to_netcdf(fname, format='NETCDF4')
+        valsxr.to_netcdf(fname, format='NETCDF4', engine='h5netcdf',
+                         encoding=encoding, unlimited_dims=[])
     else:
         print('not saving... no data')
 
@@ -317,11 +364,16 @@ if __name__ == '__main__':
     start_date = datetime.datetime(args.y,args.m,args.d)
     site_args = global_sites[args.site]
     
-    for i in range(args.ndays):
-        this_date = start_date + datetime.timedelta(days=i)
-        print(this_date)
-        try:
-            ingest_aqt(this_date,  site_args, var_attrs_aqt, odir=args.odir)
-            print("Succeed")
-        except Exception as e:
-            print("Fail", e)
+    # Each day is an independent query and file, so ingest them in parallel
+    dates = [start_date + datetime.timedelta(days=i) for i in range(args.ndays)]
+    nworkers = max(1, min(args.ndays, os.cpu_count()))
+    with ProcessPoolExecutor(max_workers=nworkers) as ex:
+        futures = {ex.submit(ingest_aqt, this_date, site_args, var_attrs_aqt,
+                             odir=args.odir): this_date for this_date in dates}
+        for future in as_completed(futures):
+            this_date = futures[future]
+            try:
+                future.result()
+                print(this_date, "Succeed")
+            except Exception as e:
+                print(this_date, "Fail", e)
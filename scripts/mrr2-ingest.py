@@ -2,13 +2,25 @@ import sage_data_client
 import requests
 import os
 
-def readtofile(uurl, ff, username, password):
-    r = requests.get(uurl, auth=(username,password))
-    if r.status_code == 200:
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def readtofile(uurl, ff, session):
+    with session.get(uurl, stream=True) as r:
+        r.raise_for_status()
         print('Downloading %s' % uurl[-18:])
-        with open(ff, 'wb') as out:
-            for bits in r.iter_content():
-                out.write(bits)
+        # Write to a temporary name so an interrupted download is never
+        # mistaken for a finished file on the next run
+        part = ff + '.part'
+        try:
+            with open(part, 'wb') as out:
+                for bits in r.iter_content(chunk_size=1024*1024):
+                    out.write(bits)
+            os.replace(part, ff)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
 
 if __name__ == "__main__":
     df = sage_data_client.query(
@@ -22,22 +34,30 @@ if __name__ == "__main__":
 
     file_list = list(df.value.values)
 
-    cur_time = ""
-    for f in file_list:
-        time_stamp = f[-18:]
-        if cur_time == time_stamp:
-            file_list.remove(f)
-        else:
-            cur_time = time_stamp
+    # Keep only the first upload for each time stamp
+    seen = set()
+    file_list = [f for f in file_list
+                 if not (f[-18:] in seen or seen.add(f[-18:]))]
             
-    username = 'jenny'
-    password = '8675309'
+    # Waggle credentials come from the environment rather than the script
+    username = os.environ['MRR_USER']
+    password = os.environ['MRR_PASS']
 
     if not os.path.exists('mrr_data'):
         os.mkdir('mrr_data')
 
 
-    temp_file_list = []
+    # Share one keep-alive connection pool between the download threads
+    session = requests.Session()
+    session.auth = (username, password)
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                          max_retries=Retry(total=3, backoff_factor=0.5))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    executor = ThreadPoolExecutor(max_workers=16)
+    downloads = []
+    temp_file_set = set()
     for f in file_list:
         name = f[-18:].replace("_", "-")
         out_dir = '/nfs/gce/projects/crocus/data/early_in_project_ingested_data/neiu-mrrpro/'
@@ -52,8 +72,12 @@ if __name__ == "__main__":
         out_name = os.path.join(out_dir, out_name)
         if not os.path.exists(out_name):
             print(f)
-            readtofile(f, out_name, username, password)
-        if not out_name in temp_file_list:
-            temp_file_list.append(out_name)
+            downloads.append(executor.submit(readtofile, f, out_name, session))
+        temp_file_set.add(out_name)
+
+    # Wait for the downloads and raise any errors from the threads
+    for download in downloads:
+        download.result()
+    executor.shutdown()
     
 
@@ -4,7 +4,9 @@
 
 import os
 import shutil
+import subprocess
 import datetime 
+import numpy as np
 from netCDF4 import Dataset, num2date
 
 import glob
@@ -30,23 +32,38 @@ def new_file_name(original_file_path, mod_time):
 
 
 
+# Seconds per unit for the netCDF time units we expect to see
+unit_seconds = {'microseconds': 1e-6, 'microsecond': 1e-6,
+                'milliseconds': 1e-3, 'millisecond': 1e-3,
+                'seconds': 1.0, 'second': 1.0, 'secs': 1.0, 's': 1.0,
+                'minutes': 60.0, 'minute': 60.0,
+                'hours': 3600.0, 'hour': 3600.0,
+                'days': 86400.0, 'day': 86400.0}
+
+
 def adjust_time_variable(time_var, mod_time, midnight):
     """
     Use file modification time.
     """
     try:
-        times = num2date(time_var[:], units=time_var.units)  # Convert num times to pyhton datetime objects
         # in this version we are getting interval from the file (No assumptions).
-        delta_seconds = [(t - times[0]).total_seconds() for t in times]  
+        # Work on the raw numeric times so the offsets are a single array operation.
+        raw_times = np.asarray(time_var[:], dtype='float64')
+        scale = unit_seconds.get(time_var.units.split()[0].lower())
+        if scale is not None:
+            delta_seconds = (raw_times - raw_times[0]) * scale
+        else:
+            # Units we do not know the scale of go through num2date
+            times = num2date(raw_times, units=time_var.units)
+            delta_seconds = np.array([(t - times[0]).total_seconds() for t in times])
         mod_time = mod_time.replace(tzinfo=None)
 
         # This end of the last observations time should be align the file's modification time.  
         # i am using delta_Seconds because vaisla files last observation time is not same as file name.
-        total_interval = (times[-1] - times[0]).total_seconds()
-        #time_interval = datetime.timedelta(seconds=delta_seconds[0])
+        total_interval = delta_seconds[-1]
         seconds_since_midnight = (mod_time - midnight).total_seconds() - total_interval
 
-        adjusted_times = [seconds_since_midnight + delta for delta in delta_seconds] 
+        adjusted_times = seconds_since_midnight + delta_seconds
         
         time_var[:] = adjusted_times  # change nc time to new times
         time_var.units = f'seconds since {midnight.strftime("%Y-%m-%d 00:00:00")}'
@@ -80,6 +97,19 @@ def adjust_time_axis(nc_file, mod_time):
 
 #
 
+def copy_file(original_file_path, new_file_path):
+    """
+    Copy-on-write clone where the filesystem supports it (XFS/Btrfs), so only the
+    patched time blocks are actually written. A hard link is not used because
+    patching it would also change the original file and its modification time.
+    """
+    try:
+        subprocess.run(['cp', '--reflink=auto', original_file_path, new_file_path],
+                       check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.copy(original_file_path, new_file_path)
+
+
 def process_file(original_file_path, latency):
     mod_time = get_modification_time(original_file_path, latency)
     if mod_time is None:
@@ -87,7 +117,7 @@ def process_file(original_file_path, latency):
     
     new_file_path = new_file_name(original_file_path, mod_time)
     try:
-        shutil.copy(original_file_path, new_file_path)
+        copy_file(original_file_path, new_file_path)
         with Dataset(new_file_path, 'r+') as nc_file:
             adjust_time_axis(nc_file, mod_time)
         logging.info(f'Processed {original_file_path} ---> {new_file_path}')
@@ -1,72 +1,112 @@
 import os
-import glob
+import re
 import xarray as xr
 import pandas as pd
 from datetime import datetime, timedelta
 import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from collections import defaultdict
+
+
+# Date stamp (YYYYMMDD_HHMMSS) that ceilometer-fix-time.py writes into the file
+# names, so other long digit runs in a name are not taken for its date
+date_pattern = re.compile(r"(\d{8})_\d{6}")
+
+
+def list_files_by_date(input_dir):
+    """
+    List input_dir once and group the netCDF files by the date in their name.
+    """
+    files_by_date = defaultdict(list)
+    for name in sorted(os.listdir(input_dir)):
+        match = date_pattern.search(name)
+        if match and name.endswith(".nc"):
+            files_by_date[match.group(1)].append(os.path.join(input_dir, name))
+    return files_by_date
+
+
+def select_files(current_date, files_by_date):
+    """
+    Return the files for one day, plus the last file of the previous day and
+    the first file of the next day to cover the day boundaries.
+    """
+    date_str = current_date.strftime("%Y%m%d")
+    prev_date_str = (current_date - timedelta(days=1)).strftime("%Y%m%d")
+    next_date_str = (current_date + timedelta(days=1)).strftime("%Y%m%d")
+
+    prev_day_files = files_by_date.get(prev_date_str, [])
+    current_day_files = files_by_date.get(date_str, [])
+    next_day_files = files_by_date.get(next_date_str, [])
+
+    selected_files = list(current_day_files)
+    if prev_day_files:
+        selected_files.insert(0, prev_day_files[-1])
+    if next_day_files:
+        selected_files.append(next_day_files[0])
+    return selected_files
+
+
+def process_day(date_str, selected_files, output_dir, prefix):
+    """
+    Write one daily file from the files picked by select_files.
+    """
+    try:
+        time_units = f"seconds since {date_str} 00:00:00"
+        encoding = {
+            "time": {
+                "units": time_units,
+                "calendar": "standard",
+                "dtype": "float64",
+            }
+        }
+
+        if selected_files:
+            daily_ds = xr.open_mfdataset(selected_files, concat_dim='time', combine='nested',
+                                         parallel=True, chunks={'time': 2048},
+                                         engine='h5netcdf')
+
+            # Select the day lazily before sorting so the boundary files are only
+            # read for the samples that fall inside it when the file is written
+            start_of_day = pd.to_datetime(date_str).floor("D")
+            end_of_day = start_of_day + timedelta(days=1)
+            times = daily_ds["time"].values
+            in_day = (times >= start_of_day) & (times < end_of_day)
+            daily_ds = daily_ds.isel(time=in_day).sortby("time")
+
+            output_path = os.path.join(output_dir, f"{prefix}{date_str}-000000.nc")
+            daily_ds.to_netcdf(output_path, engine="h5netcdf", encoding=encoding)
+            logging.info(f"Done for {date_str} --> {output_path}")
 
+            daily_ds.close()
+        else:
+            logging.warning(f"No files for day {date_str}")
+    except Exception as e:
+        logging.error(f"Error processing day {date_str}: {e}")
 
-# this function need to be broken in to smaller functions
-def process_files(args):
+
+def process_files(args, max_workers=8):
 
     input_dir= args.input
     output_dir= args.output
 
     # Convert to datetime
-    current_date = datetime.strptime(args.start, "%Y-%m-%d")
+    start_date = datetime.strptime(args.start, "%Y-%m-%d")
     end_date = datetime.strptime(args.end, "%Y-%m-%d")
-
-    while current_date <= end_date:
-        try:
-            prev_date_str = (current_date - timedelta(days=1)).strftime("%Y%m%d")
-            date_str = current_date.strftime("%Y%m%d")
-            next_date_str = (current_date + timedelta(days=1)).strftime("%Y%m%d")
-
-            time_units = f"seconds since {date_str} 00:00:00"
-            encoding = {
-                "time": {
-                    "units": time_units,
-                    "calendar": "standard",
-                    "dtype": "float64",
-                }
-            }
-
-            prev_files_pattern = os.path.join(input_dir, f"*{prev_date_str}*.nc")
-            current_files_pattern = os.path.join(input_dir, f"*{date_str}*.nc")
-            next_files_pattern = os.path.join(input_dir, f"*{next_date_str}*.nc")
-
-            prev_day_files = sorted(glob.glob(prev_files_pattern))
-            current_day_files = sorted(glob.glob(current_files_pattern))
-            next_day_files = sorted(glob.glob(next_files_pattern))
-
-            selected_files = current_day_files
-            if prev_day_files:
-                selected_files.insert(0, prev_day_files[-1])
-            if next_day_files:
-                selected_files.append(next_day_files[0])
-
-            if selected_files:
-                daily_ds = xr.open_mfdataset(selected_files, concat_dim='time', combine='nested')
-                daily_ds = daily_ds.sortby("time")
-
-                start_of_day = pd.to_datetime(date_str).floor("D")
-                end_of_day = start_of_day + timedelta(days=1)
-                daily_ds = daily_ds.sel(
-                    time=slice(start_of_day, end_of_day - pd.to_timedelta("1ms"))
-                )
-
-                output_path = os.path.join(output_dir, f"{args.prefix}{date_str}-000000.nc")
-                daily_ds.to_netcdf(output_path, encoding=encoding)
-                logging.info(f"Done for {date_str} --> {output_path}")
-
-                daily_ds.close()
-            else:
-                logging.warning(f"No files for day {date_str}")
-        except Exception as e:
-            logging.error(f"Error processing day {date_str}: {e}")
-
-        current_date += timedelta(days=1)
+    dates = [start_date + timedelta(days=i)
+             for i in range((end_date - start_date).days + 1)]
+
+    # Scan the input directory once rather than globbing it for every day, and
+    # hand each worker only the few files its day needs
+    files_by_date = list_files_by_date(input_dir)
+    date_strs = [current_date.strftime("%Y%m%d") for current_date in dates]
+    selected = [select_files(current_date, files_by_date) for current_date in dates]
+
+    # Days only share read-only boundary files, so process them independently
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        list(ex.map(partial(process_day, output_dir=output_dir, prefix=args.prefix),
+                    date_strs, selected))
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 import sage_data_client
 import pandas as pd
+import numpy as np
 from metpy.calc import dewpoint_from_relative_humidity
 from metpy.units import units
 import datetime
@@ -45,6 +46,42 @@ var_attrs_aqt = {'pm2.5' : {'standard_name' : 'mole_concentration_of_pm2p5_ambie
                 'pressure': {'standard_name' : 'air_pressure',
                        'units' : 'hPa'}}
 
+# Map Beehive variable names to output variable names
+aqt_names = {'aqt.particle.pm2.5' : 'pm2.5',
+             'aqt.particle.pm1' : 'pm1.0',
+             'aqt.particle.pm10' : 'pm10.0',
+             'aqt.gas.no' : 'no',
+             'aqt.gas.ozone' : 'o3',
+             'aqt.gas.no2' : 'no2',
+             'aqt.gas.co' : 'co',
+             'aqt.env.temp' : 'temperature',
+             'aqt.env.humidity' : 'humidity',
+             'aqt.env.pressure' : 'pressure'}
+
+# Decimal places kept for each output variable, roughly the sensor resolution
+# (gases are in ppm, so they keep ppb-level precision)
+aqt_digits = {'pm2.5' : 2,
+              'pm1.0' : 2,
+              'pm10.0' : 2,
+              'no' : 3,
+              'o3' : 3,
+              'no2' : 3,
+              'co' : 3,
+              'temperature' : 1,
+              'humidity' : 1,
+              'dewpoint' : 1,
+              'pressure' : 1}
+
+
+def quantize(data, least_significant_digit):
+    """
+    Zero the mantissa bits below least_significant_digit decimal places, as
+    netCDF4's least_significant_digit encoding does, so zlib compresses better.
+    """
+    bits = np.ceil(np.log2(10.0 ** least_significant_digit))
+    scale = 2.0 ** bits
+    return (np.around(scale * data) / scale).astype(data.dtype)
+
 
 def ingest_aqt(st, global_attrs, var_attrs):
     hours = 24
@@ -62,73 +99,67 @@ def ingest_aqt(st, global_attrs, var_attrs):
         }
     )
    
-    # Rename specific column names
-    pm25 = df_aq[df_aq['name']=='aqt.particle.pm2.5']
-    pm10 = df_aq[df_aq['name']=='aqt.particle.pm1']
-    pm100 = df_aq[df_aq['name']=='aqt.particle.pm10']
-    no = df_aq[df_aq['name']=='aqt.gas.no']
-    o3 = df_aq[df_aq['name']=='aqt.gas.ozone']
-    no2 = df_aq[df_aq['name']=='aqt.gas.no2']
-    co = df_aq[df_aq['name']=='aqt.gas.co']
-    aqtemp = df_aq[df_aq['name']=='aqt.env.temp']
-    aqhum = df_aq[df_aq['name']=='aqt.env.humidity']
-    aqpres = df_aq[df_aq['name']=='aqt.env.pressure']
-
-    # Convert instrument timestamp to Pandas Datatime object
-    pm25['time'] = pd.DatetimeIndex(pm25['timestamp'].values)
-
-    # Remove all meta data descriptions besides the index
-    aqvals = pm25.loc[:, pm25.columns.intersection(["time"])]
-
-    # Add all parameter to the output dataframe
-    aqvals['pm2.5'] = pm25.value.to_numpy().astype(float)
-    aqvals['pm1.0'] = pm10.value.to_numpy().astype(float)
-    aqvals['pm10.0'] = pm100.value.to_numpy().astype(float)
-
-    aqvals['no'] = no.value.to_numpy().astype(float)
-    aqvals['o3'] = o3.value.to_numpy().astype(float)
-    aqvals['no2'] = no2.value.to_numpy().astype(float)
-    aqvals['co'] = co.value.to_numpy().astype(float)
-    aqvals['temperature'] =  aqtemp.value.to_numpy().astype(float)
-    aqvals['humidity'] =  aqhum.value.to_numpy().astype(float)
-    aqvals['pressure'] =  aqpres.value.to_numpy().astype(float)
-
-    # calculate dewpoint from relative humidity
+    # Reshape to one column per variable in a single pass, aligned on timestamp
+    aqvals = df_aq.pivot_table(index='timestamp', columns='name',
+                               values='value', aggfunc='first')
+    aqvals = aqvals.rename(columns=aqt_names).reindex(columns=list(aqt_names.values()))
+    aqvals = aqvals.astype('float32')
+
+    # Convert instrument timestamp to Pandas Datatime object, only parsing
+    # when sage_data_client did not already return datetimes
+    if not isinstance(aqvals.index, pd.DatetimeIndex):
+        aqvals.index = pd.to_datetime(aqvals.index, cache=True, utc=True)
+    if aqvals.index.tz is not None:
+        aqvals.index = aqvals.index.tz_convert(None)
+    aqvals.index.name = 'time'
+    aqvals.sort_index(inplace=True)
+
+    # calculate dewpoint from relative humidity, stripping the units
+    # so a plain array rather than a Quantity is stored in the frame
     dp = dewpoint_from_relative_humidity(aqvals.temperature.to_numpy() * units.degC, 
                                          aqvals.humidity.to_numpy() * units.percent
     )
-    aqvals['dewpoint'] = dp
-    
-    # Define the index
-    aqvals = aqvals.set_index("time")
+    aqvals['dewpoint'] = dp.to(units.degC).magnitude.astype('float32')
+
+    # ---------
+    # Apply QC
+    #----------
+    # Check for aerosol water vapor uptake and mask out
+    bad = ~((aqvals['humidity'] > 0) & (aqvals['humidity'] < 98))
+    aqvals.loc[bad, :] = np.nan
+
+    # Drop precision beyond the sensor resolution so the output compresses well.
+    # This is done here since the h5netcdf engine does not accept the
+    # least_significant_digit encoding.
+    for varname, digits in aqt_digits.items():
+        aqvals[varname] = quantize(aqvals[varname].to_numpy(), digits)
     
     fname = st.strftime(f'{outdir}/crocus-neiu-aqt-a1-%Y%m%d-%H%M%S.nc')
     valsxr = xr.Dataset.from_dataframe(aqvals)
-    valsxr = valsxr.sortby('time')
     
     # Assign the global attributes
-    valsxr = valsxr.assign_attrs(global_attrs)
-    # Assign the individual parameter attributes
+    valsxr.attrs.update(global_attrs)
+    # Assign the individual parameter attributes in place
     for varname in var_attrs.keys():
-        valsxr[varname] = valsxr[varname].assign_attrs(var_attrs[varname])
+        valsxr[varname].attrs.update(var_attrs[varname])
     # Check if file exists and remove if necessary
     try:
         os.remove(fname)
     except OSError:
         pass
     
-    # ---------
-    # Apply QC
-    #----------
-    # Check for aerosol water vapor uptake and mask out
-    cond = (0 < valsxr.humidity) & (valsxr.humidity < 98)
-    valsxr = valsxr.where(cond, drop=False) 
-    
     # Ensure time is saved properly
     valsxr["time"] = pd.to_datetime(valsxr.time)
 
+    # Store every variable as chunked, deflated float32
+    chunksize = (min(len(valsxr.time), 8192),)
+    encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 1,
+                      'shuffle': True, 'chunksizes': chunksize,
+                      '_FillValue': np.float32(np.nan)} for var in var_attrs}
+
     if valsxr['pm2.5'].shape[0] > 0:
-        valsxr.to_netcdf(fname, format='NETCDF4')
+        valsxr.to_netcdf(fname, format='NETCDF4', engine='h5netcdf',
+                         encoding=encoding, unlimited_dims=[])
     else:
         print('not saving... no data')
 
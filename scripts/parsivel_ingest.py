@@ -5,11 +5,166 @@ import numpy as np
 import argparse
 import requests
 import sage_data_client
+import io
+import threading
+import queue
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from netCDF4 import num2date, date2num
 from ArgonneParsivelReader import read_adm_parsivel
 from datetime import datetime, timedelta
 
+# Global attributes for the output files
+global_attrs = {"site": "Argonne Deployable Mast",
+                "mentors": "Liz Wawrzyniak, Joseph O'Brien, Bobby Jackson, Bhupendra Raut",
+                "mentor_emails": "ewawrzyniak@anl.gov, obrien@anl.gov, rjackson@anl.gov, braut@anl.gov",
+                "mentor_institution": "Argonne National Laboratory",
+                "mentor_orcids": "0000-0003-4655-6912, 0000-0003-2518-1234",
+                "contributors": "Scott Collis, Paytsar Muradyan, Max Grover, Matt Tuftedal"}
+
+# Fields filled in by DropSizeDistribution.calculate_radar_parameters
+radar_params = ["Zh", "Zdr", "delta_co", "Kdp", "Ai", "Adr"]
+
+def _calculate_radar_parameters(my_dsd):
+    """
+    Calculate the radar parameters, scattering each distinct Nd spectrum once.
+
+    Most minutes in a day are rain-free and share the same all-zero spectrum, so
+    the T-matrix scattering is run on the unique rows of Nd only and the results
+    are expanded back to every time step. This temporarily shortens the DSD's
+    time axis (Nd and numt) while PyDSD scatters.
+
+    Parameters
+    ----------
+    my_dsd: pydsd.DropSizeDistribution
+        The DSD to calculate the radar parameters for.
+    """
+    nd = my_dsd.Nd["data"]
+    numt = my_dsd.numt
+    unique_nd, inverse = np.unique(nd, axis=0, return_inverse=True)
+    my_dsd.Nd["data"] = unique_nd
+    my_dsd.numt = len(unique_nd)
+    try:
+        my_dsd.calculate_radar_parameters()
+    finally:
+        my_dsd.Nd["data"] = nd
+        my_dsd.numt = numt
+    inverse = inverse.ravel()
+    for param in radar_params:
+        my_dsd.fields[param]["data"] = my_dsd.fields[param]["data"][inverse]
+
+def _meta(field):
+    """
+    Return the attributes of a PyDSD field dictionary without its data.
+    """
+    return {k: v for k, v in field.items() if k != "data"}
+
+def _download_files(filenames, session, file_queue, errors):
+    """
+    Download files in the background and put their contents on a queue.
+
+    Parameters
+    ----------
+    filenames: iterable of str
+        URLs of the files to download.
+    session: requests.Session
+        Session holding the Waggle credentials and connection pool.
+    file_queue: queue.Queue
+        Queue receiving (filename, content) tuples, followed by None once all
+        files have been downloaded.
+    errors: list
+        Receives the exception that stopped the downloads, if any, so that it
+        can be re-raised once the thread has been joined.
+    """
+    try:
+        for filename in filenames:
+            response = session.get(filename)
+            if response.status_code != 200:
+                print(f"Could not download {filename}, skipping.")
+                continue
+            file_queue.put((filename, response.content))
+    except Exception as exc:
+        errors.append(exc)
+    finally:
+        file_queue.put(None)
+
+
+def _process_one(content, radar_frequency=None):
+    """
+    Process the contents of a single Parsivel file.
+
+    Parameters
+    ----------
+    content: bytes
+        Raw contents of the file to process.
+    radar_frequency: float
+        If radar moments are to be processed into a b1-level product, then the radar frequency in Hz.
+        Set to None to skip processing radar moments to create an a1-level product with the PSDs and curve fits.
+
+    Returns
+    -------
+    out_ds: xarray.Dataset or None
+        The processed data, or None if the file is empty.
+    """
+    # Parse the downloaded bytes directly, without a round trip to disk or a
+    # decoded str copy
+    my_dsd = read_adm_parsivel(io.BytesIO(content))
+    print("PSD read in")
+    # MRR2 Frequency is 24 Ghz
+    # W-band is 95 Ghz
+    if len(my_dsd.Nd["data"]) == 0:
+        print("Empty file, skipping.")
+        return None
+    # Zero the masked bins in place and keep the plain ndarray
+    nd = my_dsd.Nd["data"]
+    if np.ma.isMaskedArray(nd):
+        np.copyto(nd.data, 0, where=np.ma.getmaskarray(nd))
+        nd = nd.data
+    my_dsd.Nd["data"] = np.ascontiguousarray(nd)
+    
+    my_dsd.calculate_dsd_parameterization()
+    if radar_frequency is not None:
+        my_dsd.set_scattering_temperature_and_frequency(scattering_freq=24e6)
+        _calculate_radar_parameters(my_dsd)
+        print("Scattering done")
+        params_list = ["Zh", "Zdr", "delta_co", "Kdp", "Ai", "Adr", "D0", "Dmax", "Dm", "Nt", "Nw", "N0", "W", "mu", "Lambda",
+                    "sensor_status", "error_code", "num_particles_validated", "power_supply_voltage", "sensor_head_heating_current",
+                    "sensor_heating_temperature", "temperature_right_head", "temperature_left_head", "sensor_time"]
+    else:
+        params_list = ["D0", "Dmax", "Dm", "Nt", "Nw", "N0", "W", "mu", "Lambda",
+                    "sensor_status", "error_code", "num_particles_validated", "power_supply_voltage", "sensor_head_heating_current",
+                    "sensor_heating_temperature", "temperature_right_head", "temperature_left_head", "sensor_time"]
+
+    # Gather every variable first and build the Dataset in a single call
+    fields = {"Nd": (['time', 'bins'], my_dsd.Nd),
+              "num_particles": (['time'], my_dsd.num_particles),
+              "velocity": (['time', 'bins'], my_dsd.velocity),
+              "rain_rate": (['time'], my_dsd.rain_rate)}
+    fields.update({param: (['time'], my_dsd.fields[param]) for param in params_list})
+    data_vars = {}
+    for var, (dims, field) in fields.items():
+        meta = _meta(field)
+        data = field["data"]
+        # The Parsivel's dynamic range fits comfortably in float32
+        if np.issubdtype(np.asarray(data).dtype, np.floating):
+            data = data.astype(np.float32, copy=False)
+        data_vars[var] = xr.DataArray(data, dims=dims, attrs=meta)
+
+    # The reader already stores time as datetime64[s], so this does not copy
+    times = np.asarray(my_dsd.time["data"], dtype="datetime64[s]")
+    edges = np.asarray(my_dsd.bin_edges["data"])
+    bins = 0.5 * (edges[1:] + edges[:-1])
+    out_ds = xr.Dataset(
+        data_vars=data_vars,
+        coords={"time": ('time', times),
+                "bin_edges": ('bin_edges', edges, _meta(my_dsd.bin_edges)),
+                "bins": ('bins', bins, {"long_name": "Bin mid points", "units": "mm"})},
+        attrs=global_attrs)
+    return out_ds
+
+
 def process_parsivel(day, radar_frequency=None, node="W09A", username="", password=""):
     """
     Process raw output from the Parsivel on the Argonne Deployable Mast.
@@ -40,78 +195,54 @@ def process_parsivel(day, radar_frequency=None, node="W09A", username="", passwo
                 "vsn" : node,
             }
         )
+    df_files = df_files.sort_values("timestamp")
     print(df_files)
-    ds_list = []
-    for filename in df_files["value"]:
-        response = requests.get(filename, auth=(username, password))
-        if response.status_code == 200:
-            # Save the file locally
-            with open("temp.csv", "wb") as file:
-                file.write(response.content)
-
-        base, name = os.path.split(filename)
-
-        my_dsd = read_adm_parsivel("temp.csv")
-        print("PSD read in")
-        # MRR2 Frequency is 24 Ghz
-        # W-band is 95 Ghz
-        if len(my_dsd.Nd["data"]) == 0:
-            print("Empty file, skipping.")
-            continue
-        my_dsd.Nd["data"] = my_dsd.Nd["data"].filled(0)
-        
-        my_dsd.calculate_dsd_parameterization()
-        out_ds = xr.Dataset()
-        out_ds["time"] = ('time', my_dsd.time["data"])
-        out_ds["bin_edges"] = ('bin_edges', my_dsd.bin_edges["data"])
-        out_ds["bin_edges"].attrs = my_dsd.bin_edges
-        del out_ds["bin_edges"].attrs["data"]
-        
-        out_ds["Nd"] = (['time', 'bins'], my_dsd.Nd["data"])
-        out_ds["Nd"].attrs = my_dsd.Nd
-        del out_ds["Nd"].attrs["data"]
-        out_ds["num_particles"] = (['time'], my_dsd.num_particles["data"])
-        out_ds["num_particles"].attrs = my_dsd.num_particles
-        del out_ds["num_particles"].attrs["data"]
-        out_ds["velocity"] = (['time', 'bins'], my_dsd.velocity["data"])
-        out_ds["velocity"].attrs = my_dsd.velocity
-        del out_ds["velocity"].attrs["data"] 
-        out_ds["rain_rate"] = (['time'], my_dsd.rain_rate["data"])
-        del my_dsd.rain_rate["data"]
-        out_ds["rain_rate"].attrs = my_dsd.rain_rate
-        if radar_frequency is not None:
-            my_dsd.set_scattering_temperature_and_frequency(scattering_freq=24e6)
-            my_dsd.calculate_radar_parameters()
-            print("Scattering done")
-            params_list = ["Zh", "Zdr", "delta_co", "Kdp", "Ai", "Adr", "D0", "Dmax", "Dm", "Nt", "Nw", "N0", "W", "mu", "Lambda",
-                        "sensor_status", "error_code", "num_particles_validated", "power_supply_voltage", "sensor_head_heating_current",
-                        "sensor_heating_temperature", "temperature_right_head", "temperature_left_head", "sensor_time"]
-            for param in params_list:
-                out_ds[param] = (['time'], my_dsd.fields[param]["data"])
-                out_ds[param].attrs = my_dsd.fields[param]
-                del out_ds[param].attrs["data"]
-        else:
-            params_list = ["D0", "Dmax", "Dm", "Nt", "Nw", "N0", "W", "mu", "Lambda",
-                        "sensor_status", "error_code", "num_particles_validated", "power_supply_voltage", "sensor_head_heating_current",
-                        "sensor_heating_temperature", "temperature_right_head", "temperature_left_head", "sensor_time"]
-            for param in params_list:
-                out_ds[param] = (['time'], my_dsd.fields[param]["data"])
-                out_ds[param].attrs = my_dsd.fields[param]
-                del out_ds[param].attrs["data"]
-        out_ds['bins'] = (['bins'],
-                        (out_ds['bin_edges'][1:].values+out_ds['bin_edges'][:-1].values)/2)
-        out_ds['bins'].attrs["long_name"] = "Bin mid points"
-        out_ds['bins'].attrs["units"] = "mm"
-        out_ds.attrs["site"] = "Argonne Deployable Mast"
-        out_ds.attrs["mentors"] = "Liz Wawrzyniak, Joseph O'Brien, Bobby Jackson, Bhupendra Raut"
-        out_ds.attrs['mentor_emails'] = "ewawrzyniak@anl.gov, obrien@anl.gov, rjackson@anl.gov, braut@anl.gov"
-        out_ds.attrs['mentor_institution'] = 'Argonne National Laboratory'
-        out_ds.attrs['mentor_orcids'] = "0000-0003-4655-6912, 0000-0003-2518-1234"
-        out_ds.attrs['contributors'] = "Scott Collis, Paytsar Muradyan, Max Grover, Matt Tuftedal"
-        out_ds["time"] = out_ds["time"].astype("datetime64[s]")
-        ds_list.append(out_ds)
-        os.remove("temp.csv")
-    out_ds = xr.concat(ds_list, dim='time').sortby("time")
+    # Iterate the underlying array rather than the pandas Series
+    filenames = df_files["value"].to_numpy()
+    # Download the next files in a background thread over one keep-alive session
+    # while the files already downloaded are processed
+    session = requests.Session()
+    session.auth = (username, password)
+    file_queue = queue.Queue(maxsize=2)
+    errors = []
+    downloader = threading.Thread(target=_download_files,
+                                  args=(filenames, session, file_queue, errors),
+                                  daemon=True)
+    downloader.start()
+
+    # Each file is independent, so spread the scattering calculations over the cores.
+    # The workers come from a forkserver so they do not inherit locks held by the
+    # downloader thread, and only a few files per worker are kept in flight.
+    max_workers = os.cpu_count()
+    futures = []
+    pending = set()
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context("forkserver")) as executor:
+        while True:
+            item = file_queue.get()
+            if item is None:
+                break
+            filename, content = item
+            print(f"Processing {filename}")
+            if len(pending) >= 2 * max_workers:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            future = executor.submit(_process_one, content, radar_frequency)
+            futures.append(future)
+            pending.add(future)
+        ds_list = [future.result() for future in futures]
+    downloader.join()
+    if errors:
+        raise errors[0]
+    ds_list = [ds for ds in ds_list if ds is not None]
+    # Files share the same bins and attributes and arrive in time order,
+    # so skip the alignment checks and only sort if the order is off
+    if len(ds_list) == 1:
+        out_ds = ds_list[0]
+    else:
+        out_ds = xr.concat(ds_list, dim='time', data_vars="minimal", coords="minimal",
+                           compat="override", join="override", combine_attrs="override")
+    if not out_ds.indexes["time"].is_monotonic_increasing:
+        out_ds = out_ds.sortby("time")
     return out_ds
 
 if __name__ == "__main__":
@@ -144,7 +275,17 @@ if __name__ == "__main__":
     del out_ds["sensor_time"].attrs["units"]
     node = args.node
     out_file = os.path.join(args.output_path, f'ADM.parsivel.{node}.{file_date}.{data_level}.nc')
-    out_ds.to_netcdf(out_file)
+
+    # Compress every variable and chunk the spectra so one chunk holds a day
+    time_len = out_ds.sizes["time"]
+    bins_len = out_ds.sizes["bins"]
+    encoding = {var: {"zlib": True, "complevel": 4, "shuffle": True} for var in out_ds.data_vars}
+    for var in out_ds.data_vars:
+        if np.issubdtype(out_ds[var].dtype, np.floating):
+            encoding[var]["dtype"] = "float32"
+        if out_ds[var].dims == ("time", "bins"):
+            encoding[var]["chunksizes"] = (min(1440, time_len), bins_len)
+    out_ds.to_netcdf(out_file, encoding=encoding, engine="netcdf4")
 
     
 